@@ -0,0 +1,158 @@
+# =========================================
+# Numba kernels for the adaptive-threshold pacemaker simulation
+# =========================================
+# Everything here is JIT-compiled on first use (and cached on disk). The fused
+# closed-loop kernel can also be built ahead of time into the `_lif_kernels`
+# extension with `python _kernels.py`; adaptive_threshold.py picks that up
+# when its SIG_VERSION matches this file and falls back to the JIT version
+# otherwise.
+
+import zlib
+
+import numpy as np
+from numba import njit, prange
+
+# (obs_ecg, I_t, v, theta, spikes, pace_times, pace_captured, sense_times, theta_base)
+#   (ecg_filt, med, mad, capture_u, gain, dead_zone, <12 LIF scalars>, <4 VVI scalars>, pulse_template)
+CLOSED_LOOP_SIG = ('Tuple((f4[:], f4[:], f4[:], f4[:], u1[:], f8[:], b1[:], f8[:], f8))'
+                   '(f4[:], f8, f8, f8[:], f8, f8, '
+                   'f8, f8, f8, f8, f8, f8, f8, f8, i8, f8, f8, f8, '
+                   'i8, i8, i8, f8, f4[:])')
+# exported by the AOT build so a stale _lif_kernels is never picked up
+SIG_VERSION = zlib.crc32(CLOSED_LOOP_SIG.encode())
+
+# Refractory, blanking and escape intervals are whole sample counts (the
+# smallest count spanning the interval) and event times are sample indices,
+# so interval tests compare integers and never tie on float rounding.
+
+# -------------------------
+# Adaptive LIF kernel (numba)
+# -------------------------
+@njit(cache=True, fastmath=True)
+def lif_step(v_t, theta_t, I, t, last_spike, beta_m, i_scale, beta_theta,
+             theta_base, theta_inc, v_reset, v_rest, refractory_samples):
+    # Decays use the exact discretization: beta = exp(-dt/tau), i_scale = (1-beta_m)*tau_m.
+    v_next = v_rest + (v_t - v_rest)*beta_m + i_scale*I
+    theta_decay = theta_base + (theta_t - theta_base)*beta_theta
+
+    # fire/reset written as a 0/1 blend so the update is straight-line code
+    fired = 0.0
+    if v_next >= theta_t and (t - last_spike) >= refractory_samples:
+        fired = 1.0
+    return (v_next*(1.0 - fired) + v_reset*fired,
+            fired*(theta_t + theta_inc) + (1.0 - fired)*theta_decay,
+            fired)
+
+@njit(cache=True, fastmath=True)
+def homeostasis(spikes, t, window_samples, theta_base,
+                homeo_rate, target_rate, homeo_window_s):
+    # rate over the spikes at or after now - window, with now = (t+1)/fs
+    rate = spikes[max(0, t+1-window_samples):t+2].sum() / max(1e-9, homeo_window_s)
+    return min(max(theta_base + homeo_rate * (target_rate - rate), 0.001), 1.0)
+
+@njit(cache=True, fastmath=True)
+def lif_run(I_t, start, end, v, theta, spikes, last_spike,
+            fs, beta_m, i_scale, beta_theta, theta_base, theta_inc,
+            v_reset, v_rest, refractory_samples, homeo_rate, target_rate, homeo_window_s):
+    # Integrates samples [start, end) in place, starting from v[start]/theta[start].
+    homeo_every = int(homeo_window_s * fs)
+    for t in range(start, end-1):
+        v[t+1], theta[t+1], fired = lif_step(
+            v[t], theta[t], I_t[t], t, last_spike, beta_m, i_scale, beta_theta,
+            theta_base, theta_inc, v_reset, v_rest, refractory_samples)
+        spikes[t+1] = fired
+        if fired:
+            last_spike = t
+
+        if (t % homeo_every) == 0 and t > 0:
+            theta_base = homeostasis(spikes, t, homeo_every, theta_base,
+                                     homeo_rate, target_rate, homeo_window_s)
+    return theta_base
+
+# -------------------------
+# Closed-loop kernel (numba)
+# -------------------------
+def _closed_loop(ecg_filt, med, mad, capture_u, gain, dead_zone,
+                 fs, beta_m, i_scale, beta_theta, theta_base, theta_inc,
+                 v_reset, v_rest, refractory_samples, homeo_rate, target_rate, homeo_window_s,
+                 escape_samples, blanking_samples, pm_refractory_samples,
+                 cap_prob, pulse_template):
+    # Sensing, VVI timing and pulse injection fused with the detector in one
+    # causal pass. A pulse at sample i only changes obs_ecg[i:i+len(pulse_template)],
+    # and I_t[i] is standardized from obs_ecg[i] right before it is integrated.
+    # capture_u holds one uniform per possible pace, drawn by the caller.
+    N = len(ecg_filt)
+    obs_ecg = ecg_filt.copy()
+    I_t = np.zeros_like(obs_ecg)
+    v = np.zeros(N, dtype=np.float32)
+    theta = np.full(N, theta_base, dtype=np.float32)
+    spikes = np.zeros(N, dtype=np.uint8)
+    homeo_every = int(homeo_window_s * fs)
+    last_spike = -10**9
+
+    pace_times = np.empty(N)
+    pace_captured = np.zeros(N, dtype=np.bool_)
+    sense_times = np.empty(N)
+    n_paced = n_sensed = 0
+    last_event = blank_until = refract_until = -10**9
+
+    sample_s = 1.0 / fs
+    for i in range(N):
+        if spikes[i] and i >= blank_until and i >= refract_until:
+            sense_times[n_sensed] = i * sample_s
+            n_sensed += 1
+            last_event = i
+            refract_until = i + pm_refractory_samples
+        if i - last_event >= escape_samples:
+            last_event = i
+            blank_until = i + blanking_samples
+            captured = capture_u[n_paced] < cap_prob
+            pace_times[n_paced] = i * sample_s
+            pace_captured[n_paced] = captured
+            n_paced += 1
+            if captured:
+                end = min(i + len(pulse_template), N)
+                obs_ecg[i:end] += pulse_template[:end-i]
+
+        ecg_std = min(max((obs_ecg[i] - med) / mad, -5.0), 10.0)
+        I_t[i] = gain * max(ecg_std - dead_zone, 0.0)
+        if i == N-1:
+            break
+        v[i+1], theta[i+1], fired = lif_step(
+            v[i], theta[i], I_t[i], i, last_spike, beta_m, i_scale, beta_theta,
+            theta_base, theta_inc, v_reset, v_rest, refractory_samples)
+        spikes[i+1] = fired
+        if fired:
+            last_spike = i
+        if (i % homeo_every) == 0 and i > 0:
+            theta_base = homeostasis(spikes, i, homeo_every, theta_base,
+                                     homeo_rate, target_rate, homeo_window_s)
+    return (obs_ecg, I_t, v, theta, spikes, pace_times[:n_paced],
+            pace_captured[:n_paced], sense_times[:n_sensed], theta_base)
+
+# no fastmath here: pycc compiles the AOT export with default FP flags, and
+# both builds should round the same way (lif_step/homeostasis keep theirs)
+closed_loop = njit(cache=True)(_closed_loop)
+
+def _sig_version():
+    return SIG_VERSION
+
+@njit(parallel=True, cache=True)
+def closed_loop_batch(ecgs, meds, mads, capture_us, params):
+    # one independent closed-loop run per row; columns are delivered/captured/sensed
+    counts = np.zeros((len(ecgs), 3), dtype=np.int64)
+    for s in prange(len(ecgs)):
+        res = closed_loop(ecgs[s], meds[s], mads[s], capture_us[s], *params)
+        counts[s, 0] = len(res[5])
+        counts[s, 1] = res[6].sum()
+        counts[s, 2] = len(res[7])
+    return counts
+
+if __name__ == '__main__':
+    # pycc is only needed for the AOT build, so importing this module for the
+    # JIT path never touches it
+    from numba.pycc import CC
+    cc = CC('_lif_kernels')
+    cc.export('closed_loop', CLOSED_LOOP_SIG)(_closed_loop)
+    cc.export('sig_version', 'i8()')(_sig_version)
+    cc.compile()
@@ -1,11 +1,22 @@
 # =========================================
 # Adaptive-Threshold SNN Pacemaker Simulation (Final Tuned Version)
 # =========================================
-!pip install numpy matplotlib scipy -q
+!pip install numpy matplotlib scipy numba -q
+
+from functools import lru_cache
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.signal import butter, filtfilt
+from scipy.signal import butter, sosfiltfilt
+
+from _kernels import (SIG_VERSION as _SIG_VERSION, lif_run as _lif_run,
+                      closed_loop as _closed_loop, closed_loop_batch as _closed_loop_batch)
+try:
+    import _lif_kernels                                      # AOT build: python _kernels.py
+    if _lif_kernels.sig_version() == _SIG_VERSION:
+        _closed_loop = _lif_kernels.closed_loop
+except (ImportError, AttributeError):
+    pass
 
 # -------------------------
 # ECG signal generator
@@ -15,38 +26,38 @@ def generate_intrinsic_ecg(duration_s=20.0, fs=250, base_hr=60, jitter=0.05,
     t = np.arange(0, duration_s, 1/fs)
     ecg = np.zeros_like(t)
     beat_interval = 60.0 / base_hr
-    next_beat = 0.0
-    while next_beat < duration_s:
-        jittered = next_beat + np.random.normal(0, jitter*beat_interval)
-        if jittered < 0:
-            next_beat += beat_interval
-            continue
-        if np.random.rand() < drop_prob:
-            next_beat += beat_interval
-            continue
-        idx = int(round(jittered * fs))
-        if idx < len(ecg):
-            width = max(1, int(0.02 * fs))
-            for i in range(width):
-                if idx + i < len(ecg):
-                    ecg[idx+i] += (1.0 - i/width) * 1.0
-        if np.random.rand() < ectopic_prob:
-            extra = jittered + np.random.uniform(0.2*beat_interval, 0.5*beat_interval)
-            idx2 = int(round(extra * fs))
-            if idx2 < len(ecg):
-                width = max(1, int(0.02 * fs))
-                for i in range(width):
-                    if idx2 + i < len(ecg):
-                        ecg[idx2+i] += (0.8 - i/width) * 1.0
-        next_beat += beat_interval
+    n_beats = int(np.ceil(duration_s / beat_interval))
+    centers = np.arange(n_beats)*beat_interval + np.random.normal(0, jitter*beat_interval, n_beats)
+    kept = (centers >= 0) & (np.random.rand(n_beats) >= drop_prob)
+    ectopic = kept & (np.random.rand(n_beats) < ectopic_prob)
+    extra = centers + np.random.uniform(0.2*beat_interval, 0.5*beat_interval, n_beats)
+
+    width = max(1, int(0.02 * fs))
+    ramp = np.arange(width) / width
+    _scatter_add(ecg, centers[kept], fs, 1.0 - ramp)
+    _scatter_add(ecg, extra[ectopic], fs, 0.8 - ramp)
     ecg += 0.05 * np.sin(2*np.pi*0.25*t)      # baseline drift
     ecg += 0.02 * np.random.randn(len(t))     # noise
     return t, ecg
 
-def bandpass(sig, fs, low=0.5, high=40.0, order=3):
+def _scatter_add(sig, times_s, fs, template):
+    # add `template` starting at each time, dropping samples past the end
+    idx = np.round(times_s * fs).astype(int)[:, None] + np.arange(len(template))
+    vals = np.broadcast_to(template, idx.shape)
+    inside = idx < len(sig)
+    np.add.at(sig, idx[inside], vals[inside])
+
+@lru_cache(maxsize=None)
+def _design_bandpass(fs, low, high, order):
+    # cached as nested tuples so callers can't mutate the shared design
     nyq = 0.5*fs
-    b, a = butter(order, [low/nyq, high/nyq], btype='band')
-    return filtfilt(b, a, sig)
+    sos = butter(order, [low/nyq, high/nyq], btype='band', output='sos')
+    return tuple(map(tuple, sos))
+
+def bandpass(sig, fs, low=0.5, high=40.0, order=3):
+    # second-order sections run in float32 end to end (coefficients and signal)
+    sos = np.array(_design_bandpass(fs, low, high, order), dtype=np.float32)
+    return sosfiltfilt(sos, sig.astype(np.float32, copy=False))
 
 # -------------------------
 # Adaptive LIF neuron (detector)
@@ -76,49 +87,53 @@ class AdaptiveLIFDetector:
         self.homeo_rate = homeo_rate
         self.target_spikes_per_sec = target_spikes_per_sec
         self.homeo_window_s = homeo_window_s
-        self.spike_times = []
+        self.beta_m = np.exp(-self.dt/self.tau_m)
+        self.one_minus_beta_m = 1 - self.beta_m
+        self.beta_theta = np.exp(-self.dt/self.tau_theta)
 
     def reset(self, length):
-        self.v = np.zeros(length)
-        self.theta = np.ones(length) * self.theta_base
-        self.spike_times = []
+        self.v = np.zeros(length, dtype=np.float32)
+        self.theta = np.full(length, self.theta_base, dtype=np.float32)
+        self.spikes = np.zeros(length, dtype=np.uint8)
 
-    def run(self, ecg_filtered):
-        T = len(ecg_filtered)
-        self.reset(T)
-        ecg_shifted = ecg_filtered - np.min(ecg_filtered)
+    def precompute_norm(self, ecg_filtered):
+        # median / MAD of the min-max scaled signal, folded back into raw units.
+        # Compute once on the intrinsic ECG and pass to preprocess() so pacing
+        # edits are standardized on the intrinsic signal's scale.
+        lo = np.min(ecg_filtered)
+        ecg_shifted = ecg_filtered - lo
+        scale = 1.0
         if np.max(ecg_shifted) > 0:
-            ecg_shifted /= (np.max(ecg_shifted) + 1e-12)
+            scale = np.max(ecg_shifted) + 1e-12
+            ecg_shifted /= scale
         med = np.median(ecg_shifted)
         mad = np.median(np.abs(ecg_shifted - med)) + 1e-9
-        ecg_std = (ecg_shifted - med) / mad
-        ecg_std = np.clip(ecg_std, -5.0, 10.0)
-        I_t = self.gain * np.clip(ecg_std - self.dead_zone, 0.0, None)
+        return float(lo + med*scale), float(mad*scale)   # f8, as CLOSED_LOOP_SIG types them
+
+    def input_current(self, ecg_filtered, med, mad):
+        ecg_std = np.clip((ecg_filtered - med) / mad, -5.0, 10.0)
+        return self.gain * np.clip(ecg_std - self.dead_zone, 0.0, None)
 
-        spikes = np.zeros(T, dtype=int)
-        last_spike_time = -1e9
-        for t in range(T-1):
-            dv = self.dt * (-(self.v[t] - self.v_rest) / self.tau_m + I_t[t])
-            self.v[t+1] = self.v[t] + dv
+    def preprocess(self, ecg_filtered, med=None, mad=None):
+        # without med/mad the signal is standardized on its own statistics
+        ecg_filtered = np.asarray(ecg_filtered, dtype=np.float32)
+        if med is None or mad is None:
+            med, mad = self.precompute_norm(ecg_filtered)
+        return self.input_current(ecg_filtered, med, mad)
 
-            refractory = ((t/self.fs) - last_spike_time) < self.refractory_s
-            if not refractory and self.v[t+1] >= self.theta[t]:
-                spikes[t+1] = 1
-                last_spike_time = t/self.fs
-                self.v[t+1] = self.v_reset
-                self.theta[t+1] = self.theta[t] + self.theta_inc
-                self.spike_times.append((t+1)/self.fs)
-            else:
-                dth = self.dt * (-(self.theta[t] - self.theta_base) / self.tau_theta)
-                self.theta[t+1] = self.theta[t] + dth
+    def run(self, ecg_filtered, I_t=None):
+        if I_t is None:
+            I_t = self.preprocess(ecg_filtered)
+        self.reset(len(I_t))
+        self.theta_base = _lif_run(I_t, 0, len(I_t), self.v, self.theta, self.spikes,
+                                   -10**9, *self._kernel_args())
+        return I_t, self.v, self.theta, self.spikes
 
-            if (t % int(self.homeo_window_s * self.fs)) == 0 and t > 0:
-                now = (t+1)/self.fs
-                wins = [s for s in self.spike_times if s >= now - self.homeo_window_s]
-                rate = len(wins) / max(1e-9, self.homeo_window_s)
-                delta = self.homeo_rate * (self.target_spikes_per_sec - rate)
-                self.theta_base = np.clip(self.theta_base + delta, 0.001, 1.0)
-        return I_t, self.v, self.theta, spikes
+    def _kernel_args(self):
+        return (self.fs, self.beta_m, self.one_minus_beta_m*self.tau_m, self.beta_theta,
+                self.theta_base, self.theta_inc, self.v_reset, self.v_rest,
+                _to_samples(self.refractory_s, self.fs), self.homeo_rate, self.target_spikes_per_sec,
+                self.homeo_window_s)
 
 # -------------------------
 # Pacemaker controller (VVI mode)
@@ -136,6 +151,9 @@ class PacemakerController:
         self.pulse_amp = pulse_amplitude_mV
         self.pulse_width_s = pulse_width_ms / 1000.0
         self.capture_threshold = capture_threshold_mV
+        self.cap_prob = 1.0 / (1.0 + np.exp(-3.0 * (self.pulse_amp - self.capture_threshold)))
+        width = max(1, int(self.pulse_width_s * fs))
+        self._pulse_template = (0.9 * (1 - np.arange(width)/width)).astype(np.float32)
         self.reset()
 
     def reset(self):
@@ -144,6 +162,12 @@ class PacemakerController:
         self.refract_until = -1e9
         self.pacing_history, self.sensed_history = [], []
 
+    def capture_draws(self, n_samples):
+        # pooled capture uniforms for the kernels, one per pace the escape
+        # interval allows in n_samples; the kernel indexes them by pace number
+        escape_samples = _to_samples(self.escape_interval_s, self.fs)
+        return np.random.random(n_samples // escape_samples + 1)
+
     def step(self, t_s, detector_spike):
         pace = captured = accepted = False
         if detector_spike and t_s >= self.blank_until and t_s >= self.refract_until:
@@ -156,14 +180,29 @@ class PacemakerController:
             pace = True
             self.last_event_time = t_s
             self.blank_until = t_s + self.blanking_s
-            cap_prob = 1.0 / (1.0 + np.exp(-3.0 * (self.pulse_amp - self.capture_threshold)))
-            captured = (np.random.rand() < cap_prob)
+            captured = (np.random.rand() < self.cap_prob)
             self.pacing_history.append((t_s, captured))
         return pace, captured, accepted
 
+    def _kernel_args(self):
+        return (_to_samples(self.escape_interval_s, self.fs),
+                _to_samples(self.blanking_s, self.fs),
+                _to_samples(self.refractory_s, self.fs),
+                self.cap_prob, self._pulse_template)
+
 # -------------------------
 # Closed-loop simulation
 # -------------------------
+def _to_samples(duration_s, fs):
+    # smallest whole number of samples spanning duration_s, tolerant of fp noise
+    return int(np.ceil(duration_s * fs - 1e-9))
+
+def _resolve_seed(seed):
+    # simulate_batch offsets from a concrete seed; None draws one from OS entropy
+    if seed is None:
+        seed = np.random.SeedSequence().entropy % 2**32
+    return int(seed)
+
 def run_closed_loop(duration_s=20.0, fs=250, intrinsic_hr=60,
                     detector_params=None, pm_params=None, seed=42):
     np.random.seed(seed)
@@ -173,30 +212,52 @@ def run_closed_loop(duration_s=20.0, fs=250, intrinsic_hr=60,
     detector = AdaptiveLIFDetector(fs=fs, **(detector_params or {}))
     pacemaker = PacemakerController(fs=fs, **(pm_params or {}))
 
-    obs_ecg = ecg_filt.copy()
-    N = len(t)
-    I_t, v, theta, spikes = detector.run(obs_ecg)
-    paced_times, captured_times, sensed_times = [], [], []
+    ecg_filt = ecg_filt.astype(np.float32, copy=False)
+    med, mad = detector.precompute_norm(ecg_filt)
+    capture_u = pacemaker.capture_draws(len(ecg_filt))   # continues np.random after synthesis
+    (obs_ecg, I_t, v, theta, spikes, pace_times, pace_captured, sense_times,
+     theta_base) = _closed_loop(
+        ecg_filt, med, mad, capture_u, detector.gain, detector.dead_zone,
+        *detector._kernel_args(), *pacemaker._kernel_args())
 
-    for i in range(N):
-        t_s = t[i]
-        detector_spike = (spikes[i] == 1)
-        pace, captured, accepted = pacemaker.step(t_s, detector_spike)
-        if accepted:
-            sensed_times.append(t_s)
-        if pace and captured:
-            paced_times.append(t_s)
-            captured_times.append(t_s)
-            width = max(1, int(pacemaker.pulse_width_s * fs))
-            for j in range(width):
-                if i + j < N:
-                    obs_ecg[i+j] += 0.9 * (1 - j/width)
-            I_t, v, theta, spikes = detector.run(obs_ecg)
+    detector.v, detector.theta, detector.spikes, detector.theta_base = v, theta, spikes, theta_base
+    pacemaker.pacing_history = list(zip(pace_times.tolist(), pace_captured.tolist()))
+    pacemaker.sensed_history = sense_times.tolist()
+    paced_times = pace_times[pace_captured].tolist()
+    captured_times = list(paced_times)
+    sensed_times = sense_times.tolist()
     return dict(t=t, intrinsic_ecg=ecg_filt, obs_ecg=obs_ecg,
                 I_t=I_t, v=v, theta=theta, spikes=spikes,
                 paced_times=paced_times, captured_times=captured_times,
                 sensed_times=sensed_times, pacemaker=pacemaker, detector=detector)
 
+def simulate_batch(n_seeds, duration_s=20.0, fs=250, intrinsic_hr=60,
+                   detector_params=None, pm_params=None, seed=42):
+    # Monte-Carlo sweep over seeds seed..seed+n_seeds-1. ECG synthesis and
+    # filtering stay in NumPy/SciPy; the closed loops run in parallel threads.
+    # `delivered` counts every pace, captured or not; `captured` matches
+    # len(run_closed_loop(...)['paced_times']), which lists captured paces only.
+    seed = _resolve_seed(seed)
+    seeds = (seed + np.arange(n_seeds)) % 2**32
+    if n_seeds == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return dict(seeds=seeds, delivered=empty, captured=empty.copy(), sensed=empty.copy())
+    detector = AdaptiveLIFDetector(fs=fs, **(detector_params or {}))
+    pacemaker = PacemakerController(fs=fs, **(pm_params or {}))
+    ecgs, capture_us = [], []
+    for s in seeds:
+        np.random.seed(s)
+        _, intrinsic_ecg = generate_intrinsic_ecg(duration_s, fs, intrinsic_hr)
+        ecgs.append(bandpass(intrinsic_ecg, fs, 0.5, 40.0))
+        capture_us.append(pacemaker.capture_draws(len(intrinsic_ecg)))
+    ecgs = np.stack(ecgs)
+    meds, mads = np.array([detector.precompute_norm(e) for e in ecgs]).T
+    params = ((detector.gain, detector.dead_zone) + detector._kernel_args()
+              + pacemaker._kernel_args())
+    counts = _closed_loop_batch(ecgs, meds, mads, np.stack(capture_us), params)
+    return dict(seeds=seeds, delivered=counts[:, 0], captured=counts[:, 1],
+                sensed=counts[:, 2])
+
 # -------------------------
 # Run demonstration
 # -------------------------